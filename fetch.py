@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
+import asyncio
 import json
-import operator
 import os
+import re
 import time
-from collections import defaultdict
-from copy import deepcopy
-from functools import reduce
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from urllib.parse import urljoin
 
 import httpx
 import jq
-import toml
+import orjson
+
+try:
+    import tomllib
+except ModuleNotFoundError:
+    import tomli as tomllib
 
 # App defines
 _CONFIG_DIR = "config"
@@ -18,7 +24,14 @@ _CONFIG_EXT = ".toml"
 _SECRET_EXT = ".secrets"
 _RESULT_DIR = "data"
 _RESULT_EXT = ".json"
+_INDEX_NAME = "_index"
 _MAXAGE_DEF = 86400
+_MAX_CONCURRENCY = 16
+_MAX_WORKERS = 8
+_MIN_PARALLEL_PARSE = 1 << 20  # bytes of TOML
+_MAX_CONNECTIONS = 64
+_MAX_KEEPALIVE = 32
+_TIMEOUT = 30
 
 # Magic keys
 _MAXAGE_KEY = "maxage"
@@ -28,190 +41,448 @@ _MAGIC_JQ = "!jq"
 _MAGIC_SECRET = "!secret"
 
 # Global state
-data = {}
+programs = {}  # compiled jq programs
+
+
+# A container on the explicit stack of map_nested
+class Frame:
+    __slots__ = ("container", "items", "key", "copy")
+
+    def __init__(self, container, key):
+        self.container = container
+        if isinstance(container, dict):
+            self.items = iter(container.items())
+        else:
+            self.items = enumerate(container)
+        self.key = key  # key of the container in its parent
+        self.copy = None  # set once f replaced one of its values
 
 
+# Walks with an explicit stack, containers are only copied along the paths where f
+# replaced a value
 def map_nested(obj, f):
-    if isinstance(obj, dict):
-        iterator = obj.items()
-    elif isinstance(obj, list):
-        iterator = enumerate(obj)
-    for k, v in iterator:
+    if not isinstance(obj, (dict, list)):
+        return f(obj)
+    stack = [Frame(obj, None)]
+    while True:
+        frame = stack[-1]
+        for k, v in frame.items:
+            if isinstance(v, (dict, list)):
+                # Descend, this frame resumes after the child is done
+                stack.append(Frame(v, k))
+                break
+            new = f(v)
+            if new is not v:
+                if frame.copy is None:
+                    frame.copy = frame.container.copy()
+                frame.copy[k] = new
+        else:
+            # All values are mapped, hand a changed container up to the parent
+            stack.pop()
+            mapped = frame.container if frame.copy is None else frame.copy
+            if not stack:
+                return mapped
+            if frame.copy is not None:
+                parent = stack[-1]
+                if parent.copy is None:
+                    parent.copy = parent.container.copy()
+                parent.copy[frame.key] = mapped
+
+
+def iter_nested(obj):
+    iterator = obj.values() if isinstance(obj, dict) else obj
+    for v in iterator:
         if isinstance(v, dict) or isinstance(v, list):
-            map_nested(v, f)
+            yield from iter_nested(v)
         else:
-            obj[k] = f(v)
+            yield v
+
+
+# Scanning the serialized tree is much cheaper than walking it
+def contains(obj, marker):
+    return marker.encode() in dump_json(obj)
+
+
+@lru_cache(maxsize=None)
+def split_path(element):
+    return tuple(element.split("."))
 
 
 def find(element, d):
-    return reduce(operator.getitem, element.split("."), d)
+    for key in split_path(element):
+        d = d[key]
+    return d
 
 
 def load_secrets():
     secrets = {}
     secrets_file = os.path.join(_CONFIG_DIR, f"{_SECRET_EXT}{_CONFIG_EXT}")
     if os.path.isfile(secrets_file):
-        with open(secrets_file) as fd:
-            secrets = toml.load(fd)
+        with open(secrets_file, "rb") as fd:
+            secrets = tomllib.load(fd)
     return secrets
 
 
 def load_unit(filepath):
-    with open(filepath, "r") as fd:
-        unit = toml.load(fd)
-        if not "headers" in unit["api"]:
-            unit["api"]["headers"] = {"content-type": "application/json"}
-        return unit
+    with open(filepath, "rb") as fd:
+        unit = tomllib.load(fd)
+    if not "headers" in unit["api"]:
+        unit["api"]["headers"] = {"content-type": "application/json"}
+    return unit
 
 
 # Uncover secrets
 def reveal(unit, secrets):
     def replace_secret(v):
-        if isinstance(v, str) and _MAGIC_SECRET in v:
-            key = v.replace(_MAGIC_SECRET, "").strip()
+        if isinstance(v, str) and v.startswith(_MAGIC_SECRET):
+            key = v[len(_MAGIC_SECRET) :].strip()
             return find(key, secrets)
         return v
 
-    revealed = deepcopy(unit)
-    map_nested(revealed, replace_secret)
-    return revealed
+    if not contains(unit, _MAGIC_SECRET):
+        return unit
+    return map_nested(unit, replace_secret)
 
 
-def prepare(request):
+def prepare(ctx, request):
     def eval_jq(v):
         if isinstance(v, str) and v.startswith(_MAGIC_JQ):
-            v = jq.all(v[len(_MAGIC_JQ) :].strip(), data)
+            source = v[len(_MAGIC_JQ) :].strip()
+            if source not in programs:
+                programs[source] = jq.compile(source)
+            v = programs[source].input(ctx).all()
             if len(v) == 1:
                 return v[0]
             return v
         return v
 
-    prepared = deepcopy(request)
-    map_nested(prepared, eval_jq)
-    return prepared
+    if not contains(request, _MAGIC_JQ):
+        return request
+    return map_nested(request, eval_jq)
 
 
 # Load configured units
 def init(targets=[]):
     secrets = load_secrets()
-    for filename in targets or os.listdir(_CONFIG_DIR):
-        if filename.endswith(_CONFIG_EXT) and _SECRET_EXT not in filename:
-            filepath = os.path.join(_CONFIG_DIR, filename)
-            if not os.path.isfile(filepath):
-                continue
-            unitname = filename.replace(_CONFIG_EXT, "")
-            unitdata = load_unit(filepath)
-            yield unitname, reveal(unitdata, secrets)
+    if targets:
+        entries = [(filename, os.path.join(_CONFIG_DIR, filename)) for filename in targets]
+        entries = [entry for entry in entries if os.path.isfile(entry[1])]
+    else:
+        with os.scandir(_CONFIG_DIR) as it:
+            entries = [(entry.name, entry.path) for entry in it if entry.is_file()]
+    entries = [
+        (filename.replace(_CONFIG_EXT, ""), filepath)
+        for filename, filepath in entries
+        if filename.endswith(_CONFIG_EXT) and _SECRET_EXT not in filename
+    ]
+
+    # Parse in parallel only when it outweighs starting the worker processes
+    filepaths = [filepath for _, filepath in entries]
+    size = sum(os.path.getsize(filepath) for filepath in filepaths)
+    if size < _MIN_PARALLEL_PARSE or (os.cpu_count() or 1) < 2:
+        units = map(load_unit, filepaths)
+    else:
+        with ProcessPoolExecutor() as pool:
+            units = list(pool.map(load_unit, filepaths))
+    for (unitname, _), unitdata in zip(entries, units):
+        yield unitname, reveal(unitdata, secrets)
+
+
+# Root keys a jq expression reads as .key, ."key" or .["key"], None if it may read others
+def references(expression):
+    keys = set()
+
+    def collect(match):
+        keys.add(next(group for group in match.groups() if group is not None))
+        return "0"
+
+    rest = re.sub(
+        r'(?<![\w\])"?.])\.(?:([A-Za-z_]\w*)|"([^"\\]*)"|\[\s*"([^"\\]*)"\s*\])',
+        collect,
+        expression,
+    )
+    rest = re.sub(r'"(?:[^"\\]|\\.)*"', '""', rest)
+
+    # Anything else reading ".", a builtin or keyword, or an object shorthand like {"key"}
+    if re.search(r'(?<![\w\])"?])\.|(?<![\w.$])[A-Za-z_]\w*|[{,]\s*""\s*[,}]', rest):
+        return None
+    return keys
+
+
+# Group the flow into waves of actions that don't depend on each other
+def schedule(unit):
+    waves = []
+    levels = {}
+    for action_id in unit["api"]["flow"]:
+        expressions = [
+            v[len(_MAGIC_JQ) :]
+            for v in iter_nested(unit["action"][action_id])
+            if isinstance(v, str) and v.startswith(_MAGIC_JQ)
+        ]
+        level = 0
+        for expression in expressions:
+            keys = references(expression)
+            for dep, dep_level in levels.items():
+                if keys is None or dep in keys:
+                    level = max(level, dep_level + 1)
+        levels[action_id] = level
+        if level == len(waves):
+            waves.append([])
+        waves[level].append(action_id)
+    return waves
 
 
 # Fetch API endpoint
-def fetch(name, api, action):
-    global data
-
-    # Construct request
-    request = defaultdict(dict)
-    request["url"] = urljoin(api["base"], action["endpoint"])
-    if "params" in api:
-        request["params"] = api["params"]
-    if "headers" in api:
-        request["headers"] = api["headers"]
-
-    if "params" in action:
-        request["params"].update(action["params"])
-    if "headers" in action:
-        request["headers"].update(action["headers"])
-
-    if "json" in action:
-        request["json"] = action["json"]
+async def fetch(client, ctx, name, api, action, validators=None):
+    # Construct request, pre-processing steps only depend on previous actions
+    method = "POST" if action["method"] == "post" else "GET"
+    url = urljoin(api["base"], action["endpoint"])
+    params = prepare(ctx, {**api.get("params", {}), **action.get("params", {})})
+    headers = {**api.get("headers", {}), **action.get("headers", {}), **(validators or {})}
+    headers = prepare(ctx, headers)
+    body = prepare(ctx, action.get("json"))
 
     page_index = 0
     while True:
-        # Run pre-processing steps
-        request = prepare(request)
-
         # Send request
-        if action["method"] == "post":
-            response = httpx.post(**request)
-        else:
-            response = httpx.get(**request)
+        request = client.build_request(method, url, params=params, headers=headers, json=body)
+        response = await client.send(request)
 
         # Handle response
+        if response.status_code == httpx.codes.NOT_MODIFIED:
+            return None, response.headers
         response.raise_for_status()  # TODO error handling
-        result = response.json()
+        result = parse_json(response.content)
 
         # Handle pagination
         if page_index == 0:
-            data[name] = result
+            ctx[name] = result
         if "paginate" not in action:
             break
         else:
-            pagination = prepare(action["paginate"])
+            pagination = prepare(ctx, action["paginate"])
             print(pagination)
 
             if page_index > 0:
                 merge = pagination["merge"]
-                result[merge] = data[name][merge] + result[merge]
-                data[name].update(result)
+                ctx[name][merge].extend(result.pop(merge))
+                ctx[name].update(result)
             if "increment" in pagination:
                 page_index = page_index + pagination["increment"]
             else:
                 page_index = page_index + 1
             if page_index >= pagination["max"]:
                 break
-            request["params"][pagination["param"]] = page_index
+            params[pagination["param"]] = page_index
             print(f"Pagination: {page_index}/{pagination['max']}")
 
-    return data[name]
+    return ctx[name], response.headers
 
 
-# Retrieve API endpoint data from cache
-def restore(name, cachefile):
-    global data
+# orjson can't read NaN/Infinity, reads integers beyond 64 bit as floats and can't
+# write them back, the stdlib json module handles those. NaN/Infinity read that way
+# are still written as null by orjson.
+def parse_json(buffer):
+    if re.search(rb"\d{20}", buffer):
+        return json.loads(buffer)
+    try:
+        return orjson.loads(buffer)
+    except orjson.JSONDecodeError:
+        return json.loads(buffer)
 
-    with open(cachefile, "r") as fd:
-        data[name] = json.load(fd)
-    return data[name]
 
+def dump_json(obj):
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, separators=(",", ":")).encode()
 
-# Run
-def run(args):
-    args = [f"{target}.toml" for target in args] if args else []
-    for name, unit in init(args):
-        actions = unit["api"]["flow"]
-        data_dir = os.path.join(_RESULT_DIR, name)
-
-        for idx, action_id in enumerate(actions):
-            action = unit["action"][action_id]
-            outfile = os.path.join(data_dir, f"{action_id}{_RESULT_EXT}")
-
-            # Check for cached results for this endpoint
-            max_age = action[_MAXAGE_KEY] if _MAXAGE_KEY in action else _MAXAGE_DEF
-            if os.path.isfile(outfile):
-                cache_age = time.time() - os.path.getmtime(outfile)
-                if cache_age <= max_age:
-                    if idx == len(actions):
-                        continue  # move on directly if this is the last action
-
-                    print(f"Restore {name}: {action_id} ({cache_age}/{max_age})")
-                    response = restore(action_id, outfile)
-                    continue
-                else:
-                    print(f"Outdated {name}: {action_id} ({cache_age}/{max_age})")
-
-            # If we didn't continue with a valid cache above, create one
-            print(f"Fetch {name}: {action_id}")
+
+def read_json(filepath):
+    with open(filepath, "rb") as fd:
+        return parse_json(fd.read())
+
+
+def write_file(filepath, buffer):
+    with open(filepath, "wb") as fd:
+        fd.write(buffer)
+
+
+# Run blocking file I/O in the thread pool to keep the event loop fetching
+def offload(f, *args):
+    return asyncio.get_running_loop().run_in_executor(None, f, *args)
+
+
+# Retrieve API endpoint data from cache
+async def restore(ctx, name, cachefile):
+    ctx[name] = await offload(read_json, cachefile)
+    return ctx[name]
+
+
+# Load the cache metadata of a unit
+def load_index(data_dir):
+    indexfile = os.path.join(data_dir, f"{_INDEX_NAME}{_RESULT_EXT}")
+    try:
+        return read_json(indexfile)
+    except FileNotFoundError:
+        return {}
+
+
+# Store the cache metadata of a unit
+def save_index(data_dir, index):
+    indexfile = os.path.join(data_dir, f"{_INDEX_NAME}{_RESULT_EXT}")
+    write_file(indexfile, dump_json(index))
+
+
+# Get the cache lifetime announced by the server, if any
+def server_ttl(headers):
+    match = re.search(r"max-age=(\d+)", headers.get("cache-control", ""))
+    if match:
+        return int(match.group(1))
+    if "expires" in headers:
+        try:
+            expires = parsedate_to_datetime(headers["expires"]).timestamp()
+            return max(0, expires - time.time())
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+# Combine the configured maxage with the lifetime announced by the server
+def lifetime(action, ttl):
+    if ttl is None:
+        return action.get(_MAXAGE_KEY, _MAXAGE_DEF)
+    return max(action.get(_MAXAGE_KEY, 0), ttl)
+
+
+# Restore or fetch a single action, returns False if the flow can't continue
+async def process(client, limit, ctx, name, unit, action_id, index, writes):
+    action = unit["action"][action_id]
+    data_dir = os.path.join(_RESULT_DIR, name)
+    outfile = os.path.join(data_dir, f"{action_id}{_RESULT_EXT}")
+
+    # Check for cached results for this endpoint
+    entry = index.get(action_id)
+    validators = {}
+    if entry:
+        max_age = lifetime(action, entry.get("ttl"))
+        cache_age = time.time() - entry["mtime"]
+        if cache_age <= max_age:
+            print(f"Restore {name}: {action_id} ({cache_age}/{max_age})")
             try:
-                response = fetch(action_id, unit["api"], action)
-            except httpx.HTTPError as exc:
-                print(f"Failed to fetch {name}: {action_id} ({exc})")
+                await restore(ctx, action_id, outfile)
+                return True
+            except FileNotFoundError:
+                print(f"Missing {name}: {action_id}")
+        else:
+            print(f"Outdated {name}: {action_id} ({cache_age}/{max_age})")
+
+        # Pages after the first aren't covered by its validators, and a 304 is
+        # useless without the cached file
+        if "paginate" not in action and os.path.isfile(outfile):
+            if entry.get("etag"):
+                validators["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                validators["If-Modified-Since"] = entry["last_modified"]
+
+    # If we didn't return with a valid cache above, create one
+    print(f"Fetch {name}: {action_id}")
+    try:
+        async with limit:
+            response, headers = await fetch(
+                client, ctx, action_id, unit["api"], action, validators
+            )
+    except httpx.HTTPError as exc:
+        print(f"Failed to fetch {name}: {action_id} ({exc})")
+        return False
+
+    # Keep the cached file if the server reports it as unchanged
+    if response is None:
+        print(f"Unchanged {name}: {action_id}")
+        try:
+            await restore(ctx, action_id, outfile)
+        except FileNotFoundError:
+            # Removed after the check above, fetch it again unconditionally
+            print(f"Missing {name}: {action_id}")
+            del index[action_id]
+            return await process(client, limit, ctx, name, unit, action_id, index, writes)
+        entry["mtime"] = time.time()
+        entry["etag"] = headers.get("etag", entry.get("etag"))
+        entry["last_modified"] = headers.get("last-modified", entry.get("last_modified"))
+        if "cache-control" in headers or "expires" in headers:
+            entry["ttl"] = server_ttl(headers)
+        return True
+
+    # Save results as a static json file, the write is awaited at the end of the unit
+    print(f"Cache {name}: {action_id}")
+    buffer = dump_json(response)
+    writes[action_id] = offload(write_file, outfile, buffer)
+    index[action_id] = {
+        "mtime": time.time(),
+        "etag": headers.get("etag"),
+        "last_modified": headers.get("last-modified"),
+        "size": len(buffer),
+        "ttl": server_ttl(headers),
+    }
+    return True
+
+
+# Run all actions of a unit, independent ones concurrently
+async def process_unit(client, limit, name, unit):
+    ctx = {}
+    data_dir = os.path.join(_RESULT_DIR, name)
+    os.makedirs(data_dir, exist_ok=True)
+    index = load_index(data_dir)
+    writes = {}
+    try:
+        for wave in schedule(unit):
+            # Let the whole wave settle so no action is still queueing writes below
+            done = await asyncio.gather(
+                *[
+                    process(client, limit, ctx, name, unit, action_id, index, writes)
+                    for action_id in wave
+                ],
+                return_exceptions=True,
+            )
+            for result in done:
+                if isinstance(result, BaseException):
+                    raise result
+            if not all(done):
                 break
+    finally:
+        # Keep the metadata of everything written so far, even if the flow failed
+        results = await asyncio.gather(*writes.values(), return_exceptions=True)
+        for action_id, result in zip(writes, results):
+            if isinstance(result, BaseException):
+                print(f"Failed to cache {name}: {action_id} ({result})")
+                del index[action_id]
+        save_index(data_dir, index)
+
+
+# Run all units concurrently
+async def process_units(units):
+    limit = asyncio.Semaphore(_MAX_CONCURRENCY)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(_MAX_WORKERS))
+    limits = httpx.Limits(
+        max_connections=_MAX_CONNECTIONS, max_keepalive_connections=_MAX_KEEPALIVE
+    )
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=_TIMEOUT) as client:
+        # A failing unit must not cancel the others
+        results = await asyncio.gather(
+            *[process_unit(client, limit, name, unit) for name, unit in units],
+            return_exceptions=True,
+        )
+    for (name, _), result in zip(units, results):
+        if isinstance(result, Exception):
+            print(f"Failed to process {name} ({result!r})")
 
-            # Save results as a static json file
-            if not os.path.exists(data_dir):
-                os.makedirs(data_dir)
-            with open(outfile, "w") as fd:
-                print(f"Cache {name}: {action_id}")
-                json.dump(response, fd, indent=4, sort_keys=True)
+
+# Run
+def run(args):
+    args = [f"{target}.toml" for target in args] if args else []
+    # Load units before starting the event loop, parsing may fork worker processes
+    units = list(init(args))
+    asyncio.run(process_units(units))
 
 
 if __name__ == "__main__":